@@ -20,6 +20,7 @@ requires = [
     "cornice",
     "gevent[monitor]",
     "lazr.sshserver>=0.1.7",
+    "orjson",
     "Paste",
     "pygit2>=0.28.1,<1.1.0",
     "python-openid2",
@@ -5,8 +5,11 @@
 
 import resource
 
+from cornice.renderer import CorniceRenderer
 from pyramid.config import Configurator
 
+from turnip.api.formatter import dumps_json
+
 
 def main(global_config, **settings):
     # Allow slack for lots of open pack files.
@@ -16,5 +19,6 @@ def main(global_config, **settings):
 
     config = Configurator(settings=settings)
     config.include("cornice")
+    config.add_renderer("cornicejson", CorniceRenderer(serializer=dumps_json))
     config.scan("turnip.api.views")
     return config.make_wsgi_app()
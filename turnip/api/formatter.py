@@ -2,7 +2,9 @@
 # GNU Affero General Public License version 3 (see the file LICENSE).
 
 import base64
+import itertools
 
+import orjson
 from pygit2 import (
     GIT_OBJ_BLOB,
     GIT_OBJ_COMMIT,
@@ -19,6 +21,42 @@ REF_TYPE_NAME = {
 }
 
 
+def dumps_json(value, default=None, **kw):
+    """Serialize value to JSON bytes.
+
+    This has the signature of the serializer expected by pyramid's JSON
+    renderer, and accepts (but ignores) any other json.dumps arguments.
+    """
+    return orjson.dumps(value, default=default)
+
+
+def iter_json(value, default=None, batch_size=100):
+    """Serialize a list or dict to JSON, yielding it in chunks of bytes.
+
+    Each chunk holds up to batch_size members, so large responses are
+    never built as a single bytes object.  default is passed to
+    dumps_json for objects it cannot serialize itself.
+    """
+    if isinstance(value, dict):
+        opening, closing = b"{", b"}"
+        members = (
+            dumps_json(key) + b":" + dumps_json(member, default=default)
+            for key, member in value.items()
+        )
+    else:
+        opening, closing = b"[", b"]"
+        members = (dumps_json(member, default=default) for member in value)
+    yield opening
+    separator = b""
+    while True:
+        batch = list(itertools.islice(members, batch_size))
+        if not batch:
+            break
+        yield separator + b",".join(batch)
+        separator = b","
+    yield closing
+
+
 def format_blob(blob):
     """Return a formatted blob dict."""
     if blob.type != GIT_OBJ_BLOB:
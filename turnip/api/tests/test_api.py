@@ -7,7 +7,6 @@ import re
 import subprocess
 import time
 import unittest
-import uuid
 from datetime import datetime, timedelta
 from textwrap import dedent
 from unittest import mock
@@ -22,18 +21,49 @@ from twisted.web import server
 from webtest import TestApp
 
 from turnip import api
-from turnip.api.tests.test_helpers import RepoFactory, get_revlist, open_repo
+from turnip.api.tests.test_helpers import (
+    TEMP_ROOT,
+    RepoFactory,
+    get_revlist,
+    open_repo,
+    unique_name,
+)
 from turnip.config import config
 from turnip.pack.tests.fake_servers import FakeVirtInfoService
 from turnip.tests.tasks import CeleryWorkerFixture
 
+_app = None
+
+
+def get_app():
+    """Return a TestApp shared by all API tests.
+
+    The views look up REPO_STORE afresh for each request, so one
+    application can serve every test while each test points REPO_STORE at
+    its own directory.
+    """
+    global _app
+    if _app is None:
+        _app = TestApp(api.main({}))
+    return _app
+
 
 class ApiRepoStoreMixin:
+    """Per-test repository store for API tests.
+
+    Each test gets its own temporary REPO_STORE, exported through the
+    process environment.  That keeps tests isolated from each other when
+    run in separate processes (e.g. under pytest-xdist), but tests must
+    not be run concurrently in threads of a single process.
+    """
+
     def setupRepoStore(self):
-        repo_store = self.useFixture(TempDir()).path
+        repo_store = self.useFixture(TempDir(rootdir=TEMP_ROOT)).path
         self.useFixture(EnvironmentVariable("REPO_STORE", repo_store))
-        self.app = TestApp(api.main({}))
-        self.repo_path = uuid.uuid1().hex
+        self.addCleanup(open_repo.cache_clear)
+        self.app = get_app()
+        self.repo_path = unique_name()
+        self.repo_url = f"/repo/{self.repo_path}"
         self.repo_store = os.path.join(repo_store, self.repo_path)
         self.repo_root = repo_store
         self.commit = {"ref": "refs/heads/master", "message": "test commit."}
@@ -52,9 +82,8 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         )
 
     def get_ref(self, ref):
-        repo_path = six.ensure_text(self.repo_path)
         ref = six.ensure_text(ref)
-        url = f"/repo/{repo_path}/{ref}"
+        url = f"{self.repo_url}/{ref}"
         resp = self.app.get(quote(url))
         return resp.json
 
@@ -63,12 +92,41 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         self.assertIn(self.repo_path, resp.json["repo_url"])
         self.assertEqual(200, resp.status_code)
 
+    def test_repo_init_with_repo_store_setting(self):
+        """The repo_store setting overrides the environment."""
+        repo_store = self.useFixture(TempDir(rootdir=TEMP_ROOT)).path
+        app = TestApp(api.main({}, repo_store=repo_store))
+        resp = app.post_json("/repo", {"repo_path": self.repo_path})
+        self.assertEqual(200, resp.status_code)
+        self.assertTrue(
+            os.path.exists(os.path.join(repo_store, self.repo_path))
+        )
+        self.assertFalse(os.path.exists(self.repo_store))
+
     def test_repo_init_with_invalid_repo_path(self):
         resp = self.app.post_json(
             "/repo", {"repo_path": "../1234"}, expect_errors=True
         )
         self.assertEqual(404, resp.status_code)
 
+    def test_repo_init_with_sibling_repo_path(self):
+        """A sibling path sharing the repo store's prefix is rejected."""
+        sibling = "../" + os.path.basename(self.repo_root) + "-sibling"
+        resp = self.app.post_json(
+            "/repo", {"repo_path": sibling}, expect_errors=True
+        )
+        self.assertEqual(404, resp.status_code)
+
+    def test_repo_init_with_symlink_out_of_repo_store(self):
+        """A symlink in the repo store may not point outside it."""
+        outside = self.useFixture(TempDir(rootdir=TEMP_ROOT)).path
+        os.symlink(outside, os.path.join(self.repo_root, self.repo_path))
+        resp = self.app.post_json(
+            "/repo", {"repo_path": self.repo_path}, expect_errors=True
+        )
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual([], os.listdir(outside))
+
     def test_repo_init_with_existing_repo(self):
         """Repo can be not be initialised with existing path."""
         factory = RepoFactory(self.repo_store)
@@ -82,7 +140,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         """Repo can be initialised with optional clone."""
         factory = RepoFactory(self.repo_store, num_commits=2)
         factory.build()
-        new_repo_path = uuid.uuid1().hex
+        new_repo_path = unique_name()
         resp = self.app.post_json(
             "/repo",
             {
@@ -106,13 +164,18 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         factory.build()
         factory.repo.set_head("refs/heads/branch-0")
 
-        resp = self.app.get(f"/repo/{self.repo_path}")
+        resp = self.app.get(self.repo_url)
         self.assertEqual(200, resp.status_code)
         self.assertEqual(
             {"default_branch": "refs/heads/branch-0", "is_available": True},
             resp.json,
         )
 
+    def test_repo_get_name_too_long(self):
+        """A repository name too long for the filesystem returns 404."""
+        resp = self.app.get("/repo/" + "a" * 300, expect_errors=True)
+        self.assertEqual(404, resp.status_code)
+
     def test_repo_get_default_branch_missing(self):
         """default_branch is returned even if that branch has been deleted."""
         factory = RepoFactory(self.repo_store, num_branches=2, num_commits=1)
@@ -120,7 +183,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         factory.repo.set_head("refs/heads/branch-0")
         factory.repo.references.delete("refs/heads/branch-0")
 
-        resp = self.app.get(f"/repo/{self.repo_path}")
+        resp = self.app.get(self.repo_url)
         self.assertEqual(200, resp.status_code)
         self.assertEqual(
             {"default_branch": "refs/heads/branch-0", "is_available": True},
@@ -135,7 +198,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         self.assertReferencesEqual(factory.repo, "refs/heads/branch-0", "HEAD")
 
         resp = self.app.patch_json(
-            f"/repo/{self.repo_path}",
+            self.repo_url,
             {"default_branch": "refs/heads/branch-1"},
         )
         self.assertEqual(204, resp.status_code)
@@ -146,7 +209,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         factory = RepoFactory(self.repo_store)
         c1 = factory.add_commit("foo", "foobar.txt")
 
-        repo2_name = uuid.uuid4().hex
+        repo2_name = unique_name()
         factory2 = RepoFactory(
             os.path.join(self.repo_root, repo2_name), clone_from=factory
         )
@@ -165,7 +228,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         factory = RepoFactory(self.repo_store)
         c1 = factory.add_commit("foo", "foobar.txt")
 
-        repo2_name = uuid.uuid4().hex
+        repo2_name = unique_name()
         factory2 = RepoFactory(
             os.path.join(self.repo_root, repo2_name), clone_from=factory
         )
@@ -190,7 +253,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         factory = RepoFactory(self.repo_store)
         c1 = factory.add_commit("foo", "foobar.txt")
 
-        repo2_name = uuid.uuid4().hex
+        repo2_name = unique_name()
         RepoFactory(
             os.path.join(self.repo_root, repo2_name), clone_from=factory
         )
@@ -206,7 +269,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
 
     def test_repo_delete(self):
         self.app.post_json("/repo", {"repo_path": self.repo_path})
-        resp = self.app.delete(f"/repo/{self.repo_path}")
+        resp = self.app.delete(self.repo_url)
         self.assertEqual(200, resp.status_code)
         self.assertFalse(os.path.exists(self.repo_store))
 
@@ -218,19 +281,21 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         subprocess.check_call(
             ["git", "-C", self.repo_store, "branch", b"\x80"]
         )
-        resp = self.app.delete(f"/repo/{self.repo_path}")
+        resp = self.app.delete(self.repo_url)
         self.assertEqual(200, resp.status_code)
         self.assertFalse(os.path.exists(self.repo_store))
 
     def test_repo_get_refs(self):
         """Ensure expected ref objects are returned and shas match."""
         ref = self.commit.get("ref")
-        repo = RepoFactory(self.repo_store, num_commits=1, num_tags=1).build()
-        resp = self.app.get(f"/repo/{self.repo_path}/refs")
+        repo = RepoFactory.from_template(
+            self.repo_store, num_commits=1, num_tags=1
+        ).repo
+        resp = self.app.get(f"{self.repo_url}/refs")
         body = resp.json
 
-        self.assertTrue(ref in body)
-        self.assertTrue(self.tag.get("ref") in body)
+        self.assertIn(ref, body)
+        self.assertIn(self.tag.get("ref"), body)
 
         oid = repo.head.peel().oid.hex  # git object sha
         resp_sha = body[ref]["object"].get("sha1")
@@ -246,7 +311,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         commit_oid = factory.add_commit("foo", "foobar.txt")
 
         resp = self.app.post_json(
-            f"/repo/{self.repo_path}/refs", [], expect_errors=True
+            f"{self.repo_url}/refs", [], expect_errors=True
         )
         self.assertEqual(400, resp.status_code)
         self.assertIn(
@@ -256,7 +321,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
 
         missing_sha_1 = [{"ref": "1701"}]
         resp = self.app.post_json(
-            f"/repo/{self.repo_path}/refs", missing_sha_1, expect_errors=True
+            f"{self.repo_url}/refs", missing_sha_1, expect_errors=True
         )
         self.assertEqual(400, resp.status_code)
         self.assertIn(
@@ -270,7 +335,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
             }
         ]
         resp = self.app.post_json(
-            f"/repo/{self.repo_path}/refs",
+            f"{self.repo_url}/refs",
             missing_ref_name,
             expect_errors=True,
         )
@@ -291,7 +356,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
             },
         ]
         resp = self.app.post_json(
-            f"/repo/{self.repo_path}/refs",
+            f"{self.repo_url}/refs",
             duplicate_ref_name,
             expect_errors=True,
         )
@@ -308,7 +373,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
             }
         ]
         resp = self.app.post_json(
-            f"/repo/{self.repo_path}/refs",
+            f"{self.repo_url}/refs",
             wrong_ref_name_format,
             expect_errors=True,
         )
@@ -326,7 +391,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
             }
         ]
         resp = self.app.post_json(
-            f"/repo/{self.repo_path}/refs",
+            f"{self.repo_url}/refs",
             bad_force_option,
             expect_errors=True,
         )
@@ -349,7 +414,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
                     "commit_sha1": commit_sha1,
                 }
             ]
-            resp = self.app.post_json(f"/repo/{self.repo_path}/refs", body)
+            resp = self.app.post_json(f"{self.repo_url}/refs", body)
             self.assertEqual(201, resp.status_code)
             self.assertEqual({ref: commit_sha1}, resp.json["created"])
             self.assertEqual({}, resp.json["errors"])
@@ -370,7 +435,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
                     "force": True,
                 }
             ]
-            resp = self.app.post_json(f"/repo/{self.repo_path}/refs", body)
+            resp = self.app.post_json(f"{self.repo_url}/refs", body)
             self.assertEqual(201, resp.status_code)
             self.assertEqual({ref: commit_oid.hex}, resp.json["created"])
             self.assertEqual({}, resp.json["errors"])
@@ -429,9 +494,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         )
         expected_errors.append((existing_ref, commits[0].hex))
 
-        resp = self.app.post_json(
-            f"/repo/{self.repo_path}/refs", refs_to_create
-        )
+        resp = self.app.post_json(f"{self.repo_url}/refs", refs_to_create)
         created = resp.json["created"]
         errors = resp.json["errors"]
 
@@ -461,11 +524,11 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         body = [
             {
                 "ref": tag_name,
-                "commit_sha1": factory.nonexistent_oid(),
+                "commit_sha1": nonexistent_commit,
             }
         ]
         resp = self.app.post_json(
-            f"/repo/{self.repo_path}/refs", body, expect_errors=True
+            f"{self.repo_url}/refs", body, expect_errors=True
         )
         # 400 response code if nothing is created and we have only errors
         self.assertEqual(400, resp.status_code)
@@ -483,7 +546,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         tag_message = "tag message"
         factory.add_tag(tag, tag_message, commit_oid)
 
-        resp = self.app.get(f"/repo/{self.repo_path}/refs")
+        resp = self.app.get(f"{self.repo_url}/refs")
         refs = resp.json
         self.assertEqual(1, len(refs.keys()))
 
@@ -495,7 +558,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         tag_message = "かわいい タコ".encode()
         factory.add_tag(tag, tag_message, commit_oid)
 
-        resp = self.app.get(f"/repo/{self.repo_path}/refs")
+        resp = self.app.get(f"{self.repo_url}/refs")
         refs = resp.json
         self.assertEqual(2, len(refs.keys()))
 
@@ -511,9 +574,9 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
             factory.repo.references.create(ref_path, factory.commits[0])
 
         resp = self.app.get(
-            "/repo/{}/refs"
+            "{}/refs"
             "?exclude_prefix=refs/changes/"
-            "&exclude_prefix=refs/pull/".format(self.repo_path)
+            "&exclude_prefix=refs/pull/".format(self.repo_url)
         )
         refs = resp.json
         self.assertThat(
@@ -528,7 +591,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         RepoFactory(self.repo_store, num_commits=1).build()
         ref = "refs/heads/master"
         resp = self.get_ref(ref)
-        self.assertTrue(ref in resp)
+        self.assertIn(ref, resp)
 
     def test_repo_get_ref_nonexistent_repository(self):
         """get_ref on a non-existent repository returns HTTP 404."""
@@ -538,10 +601,10 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
     def test_repo_get_ref_nonexistent_ref(self):
         """get_ref on a non-existent ref in a repository returns HTTP 404."""
         RepoFactory(self.repo_store, num_commits=1).build()
-        resp = self.app.get(f"/repo/{self.repo_path}/refs/heads/master")
+        resp = self.app.get(f"{self.repo_url}/refs/heads/master")
         self.assertEqual(200, resp.status_code)
         resp = self.app.get(
-            f"/repo/{self.repo_path}/refs/heads/nonexistent",
+            f"{self.repo_url}/refs/heads/nonexistent",
             expect_errors=True,
         )
         self.assertEqual(404, resp.status_code)
@@ -562,10 +625,10 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         self.assertIn(tag, resp)
 
     def test_repo_get_tag(self):
-        RepoFactory(self.repo_store, num_commits=1, num_tags=1).build()
+        RepoFactory.from_template(self.repo_store, num_commits=1, num_tags=1)
         tag = self.tag.get("ref")
         resp = self.get_ref(tag)
-        self.assertTrue(tag in resp)
+        self.assertIn(tag, resp)
 
     def test_delete_ref(self):
         celery_fixture = CeleryWorkerFixture()
@@ -577,7 +640,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         self.assertEqual(7, len(repo.references.objects))
 
         ref = "refs/heads/branch-0"
-        url = f"/repo/{self.repo_path}/{ref}"
+        url = f"{self.repo_url}/{ref}"
         resp = self.app.delete(quote(url))
 
         self.assertEqual(6, len(repo.references.objects))
@@ -594,7 +657,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         self.assertEqual(7, len(repo.references.objects))
 
         ref = "refs/heads/fake-branch"
-        url = f"/repo/{self.repo_path}/{ref}"
+        url = f"{self.repo_url}/{ref}"
         resp = self.app.delete(quote(url), expect_errors=True)
         self.assertEqual(404, resp.status_code)
         self.assertEqual(
@@ -718,7 +781,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         c1_oid = repo.add_commit("foo", "foobar.txt")
         c2_oid = repo.add_commit("bar", "foobar.txt", parents=[c1_oid])
 
-        path = f"/repo/{self.repo_path}/compare/{c1_oid}..{c2_oid}"
+        path = f"{self.repo_url}/compare/{c1_oid}..{c2_oid}"
         resp = self.app.get(path)
         self.assertIn(b"-foo", resp.body)
         self.assertIn(b"+bar", resp.body)
@@ -729,7 +792,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         c1_oid = repo.add_commit("foo", "foobar.txt")
         c2_oid = repo.add_commit("bar", "foobar.txt", parents=[c1_oid])
 
-        path = f"/repo/{self.repo_path}/compare/{c1_oid}..{c2_oid}"
+        path = f"{self.repo_url}/compare/{c1_oid}..{c2_oid}"
         resp = self.app.get(path)
         self.assertIn(c1_oid.hex, resp.json["commits"][0]["sha1"])
         self.assertIn(c2_oid.hex, resp.json["commits"][1]["sha1"])
@@ -742,7 +805,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         oid = factory.add_commit(message, "foo.py")
         oid2 = factory.add_commit(message2, "bar.py", [oid])
 
-        resp = self.app.get(f"/repo/{self.repo_path}/compare/{oid}..{oid2}")
+        resp = self.app.get(f"{self.repo_url}/compare/{oid}..{oid2}")
         self.assertEqual(
             resp.json["commits"][0]["message"], message.decode("utf-8")
         )
@@ -757,7 +820,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         oid = factory.add_commit(message, "foo.py")
         oid2 = factory.add_commit("a sensible commit message", "foo.py", [oid])
 
-        resp = self.app.get(f"/repo/{self.repo_path}/compare/{oid}..{oid2}")
+        resp = self.app.get(f"{self.repo_url}/compare/{oid}..{oid2}")
         self.assertEqual(
             resp.json["commits"][0]["message"],
             message.decode("utf-8", "replace"),
@@ -767,7 +830,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         """get_diff on a non-existent sha1 returns HTTP 404."""
         RepoFactory(self.repo_store).build()
         resp = self.app.get(
-            f"/repo/{self.repo_path}/compare/1..2", expect_errors=True
+            f"{self.repo_url}/compare/1..2", expect_errors=True
         )
         self.assertEqual(404, resp.status_code)
 
@@ -775,7 +838,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         """get_diff with an invalid separator (not ../...) returns HTTP 404."""
         RepoFactory(self.repo_store).build()
         resp = self.app.get(
-            f"/repo/{self.repo_path}/compare/1++2", expect_errors=True
+            f"{self.repo_url}/compare/1++2", expect_errors=True
         )
         self.assertEqual(400, resp.status_code)
 
@@ -789,9 +852,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         c3_left = repo.add_commit("corge", "foobar.txt", parents=[c2_left])
 
         resp = self.app.get(
-            "/repo/{}/compare/{}...{}".format(
-                self.repo_path, c3_left, c3_right
-            )
+            "{}/compare/{}...{}".format(self.repo_url, c3_left, c3_right)
         )
         self.assertIn("-foo", resp.json_body["patch"])
         self.assertIn("+baz", resp.json_body["patch"])
@@ -803,7 +864,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         repo = RepoFactory(self.repo_store)
         c1 = repo.add_commit("foo\n", "blah.txt")
 
-        resp = self.app.get(f"/repo/{self.repo_path}/compare/{c1}..{c1}")
+        resp = self.app.get(f"{self.repo_url}/compare/{c1}..{c1}")
         self.assertEqual("", resp.json_body["patch"])
 
     def test_repo_get_diff_extended_revision(self):
@@ -812,9 +873,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         c1 = repo.add_commit("foo\n", "foobar.txt")
         c2 = repo.add_commit("bar\n", "foobar.txt", parents=[c1])
 
-        path = "/repo/{}/compare/{}..{}".format(
-            self.repo_path, quote(f"{c2}^"), c2
-        )
+        path = "{}/compare/{}..{}".format(self.repo_url, quote(f"{c2}^"), c2)
         resp = self.app.get(path)
         self.assertIn(b"-foo", resp.body)
         self.assertIn(b"+bar", resp.body)
@@ -826,9 +885,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         repo.repo.index.remove("foo.txt")
         c2 = repo.add_commit("foo\n", "bar.txt", parents=[c1])
 
-        path = "/repo/{}/compare/{}..{}".format(
-            self.repo_path, quote(f"{c2}^"), c2
-        )
+        path = "{}/compare/{}..{}".format(self.repo_url, quote(f"{c2}^"), c2)
         resp = self.app.get(path)
         self.assertIn(
             "diff --git a/foo.txt b/bar.txt\n", resp.json_body["patch"]
@@ -841,7 +898,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         repo1.set_head(c1)
 
         # Fork and change the content of foo.txt in repo2.
-        repo2_name = uuid.uuid4().hex
+        repo2_name = unique_name()
         repo2 = RepoFactory(
             os.path.join(self.repo_root, repo2_name), clone_from=repo1
         )
@@ -895,9 +952,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         )
 
         resp = self.app.get(
-            "/repo/{}/compare-merge/{}:{}".format(
-                self.repo_path, c3_right, c3_left
-            )
+            "{}/compare-merge/{}:{}".format(self.repo_url, c3_right, c3_left)
         )
         self.assertIn(" quux", resp.json_body["patch"])
         self.assertIn("-baz", resp.json_body["patch"])
@@ -917,9 +972,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         )
 
         resp = self.app.get(
-            "/repo/{}/compare-merge/{}:{}".format(
-                self.repo_path, c2_left, c2_right
-            )
+            "{}/compare-merge/{}:{}".format(self.repo_url, c2_left, c2_right)
         )
         self.assertIn(
             dedent(
@@ -944,9 +997,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         c2_right = repo.add_commit("", "bar.txt", parents=[c1])
 
         resp = self.app.get(
-            "/repo/{}/compare-merge/{}:{}".format(
-                self.repo_path, c2_left, c2_right
-            )
+            "{}/compare-merge/{}:{}".format(self.repo_url, c2_left, c2_right)
         )
         self.assertIn(
             dedent(
@@ -975,9 +1026,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         c2_right = repo.add_commit("foo\nbar\n", "foo.txt", parents=[c1])
 
         resp = self.app.get(
-            "/repo/{}/compare-merge/{}:{}".format(
-                self.repo_path, c2_left, c2_right
-            )
+            "{}/compare-merge/{}:{}".format(self.repo_url, c2_left, c2_right)
         )
         self.assertIn(
             dedent(
@@ -1004,8 +1053,8 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         c3 = repo.add_commit("foo\nbar\nbaz\n", "blah.txt", parents=[c2])
 
         resp = self.app.get(
-            "/repo/{}/compare-merge/{}:{}?sha1_prerequisite={}".format(
-                self.repo_path, c1, c3, c2
+            "{}/compare-merge/{}:{}?sha1_prerequisite={}".format(
+                self.repo_url, c1, c3, c2
             )
         )
         self.assertIn(
@@ -1027,7 +1076,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         repo = RepoFactory(self.repo_store)
         c1 = repo.add_commit("foo\n", "blah.txt")
 
-        resp = self.app.get(f"/repo/{self.repo_path}/compare-merge/{c1}:{c1}")
+        resp = self.app.get(f"{self.repo_url}/compare-merge/{c1}:{c1}")
         self.assertEqual("", resp.json_body["patch"])
 
     def test_repo_diff_merge_nonexistent(self):
@@ -1036,8 +1085,8 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         c1 = repo.add_commit("foo\n", "blah.txt")
 
         resp = self.app.get(
-            "/repo/{}/compare-merge/{}:{}".format(
-                self.repo_path, repo.nonexistent_oid(), c1
+            "{}/compare-merge/{}:{}".format(
+                self.repo_url, repo.nonexistent_oid(), c1
             ),
             expect_errors=True,
         )
@@ -1050,7 +1099,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         repo.repo.index.remove("foo.txt")
         c2 = repo.add_commit("foo\n", "bar.txt", parents=[c1])
 
-        resp = self.app.get(f"/repo/{self.repo_path}/compare-merge/{c1}:{c2}")
+        resp = self.app.get(f"{self.repo_url}/compare-merge/{c1}:{c2}")
         self.assertIn(
             "diff --git a/foo.txt b/bar.txt\n", resp.json_body["patch"]
         )
@@ -1060,7 +1109,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         message = "Computers make me angry."
         commit_oid = factory.add_commit(message, "foobar.txt")
 
-        resp = self.app.get(f"/repo/{self.repo_path}/commits/{commit_oid.hex}")
+        resp = self.app.get(f"{self.repo_url}/commits/{commit_oid.hex}")
         commit_resp = resp.json
         self.assertEqual(commit_oid.hex, commit_resp["sha1"])
         self.assertEqual(message, commit_resp["message"])
@@ -1069,9 +1118,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         """Trying to get a non-existent OID returns HTTP 404."""
         factory = RepoFactory(self.repo_store)
         resp = self.app.get(
-            "/repo/{}/commits/{}".format(
-                self.repo_path, factory.nonexistent_oid()
-            ),
+            "{}/commits/{}".format(self.repo_url, factory.nonexistent_oid()),
             expect_errors=True,
         )
         self.assertEqual(404, resp.status_code)
@@ -1082,27 +1129,27 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         factory.build()
         tree_oid = factory.repo[factory.commits[0]].tree.hex
         resp = self.app.get(
-            f"/repo/{self.repo_path}/commits/{tree_oid}",
+            f"{self.repo_url}/commits/{tree_oid}",
             expect_errors=True,
         )
         self.assertEqual(404, resp.status_code)
 
     def test_repo_get_commit_collection(self):
         """Ensure commits can be returned in bulk."""
-        factory = RepoFactory(self.repo_store, num_commits=10)
-        factory.build()
+        factory = RepoFactory.from_template(
+            self.repo_store, num_commits=10, pack=True
+        )
         bulk_commits = {"commits": [c.hex for c in factory.commits[0::2]]}
 
-        resp = self.app.post_json(
-            f"/repo/{self.repo_path}/commits", bulk_commits
-        )
+        resp = self.app.post_json(f"{self.repo_url}/commits", bulk_commits)
         self.assertEqual(5, len(resp.json))
         self.assertEqual(bulk_commits["commits"][0], resp.json[0]["sha1"])
 
     def test_repo_get_commit_collection_ignores_errors(self):
         """Non-existent OIDs and non-commits in a collection are ignored."""
-        factory = RepoFactory(self.repo_store, num_commits=10)
-        factory.build()
+        factory = RepoFactory.from_template(
+            self.repo_store, num_commits=10, pack=True
+        )
         bulk_commits = {
             "commits": [
                 factory.commits[0].hex,
@@ -1111,9 +1158,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
             ],
         }
 
-        resp = self.app.post_json(
-            f"/repo/{self.repo_path}/commits", bulk_commits
-        )
+        resp = self.app.post_json(f"{self.repo_url}/commits", bulk_commits)
         self.assertEqual(1, len(resp.json))
         self.assertEqual(bulk_commits["commits"][0], resp.json[0]["sha1"])
 
@@ -1131,7 +1176,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
             "commits": [c1.hex, c2.hex],
         }
 
-        resp = self.app.post_json(f"/repo/{self.repo_path}/commits", payload)
+        resp = self.app.post_json(f"{self.repo_url}/commits", payload)
 
         self.assertEqual(1, len(resp.json))
         self.assertIn("blobs", resp.json[0])
@@ -1156,7 +1201,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
             "commits": [c1.hex, c2.hex],
         }
 
-        resp = self.app.post_json(f"/repo/{self.repo_path}/commits", payload)
+        resp = self.app.post_json(f"{self.repo_url}/commits", payload)
 
         self.assertEqual(1, len(resp.json))
         self.assertIn("blobs", resp.json[0])
@@ -1184,14 +1229,13 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
             author=author,
             committer=committer,
         )
-        resp = self.app.get(f"/repo/{self.repo_path}/log/{oid}")
+        resp = self.app.get(f"{self.repo_url}/log/{oid}")
         self.assertEqual(author.name, resp.json[0]["author"]["name"])
 
     def test_repo_get_log(self):
-        factory = RepoFactory(self.repo_store, num_commits=4)
-        factory.build()
+        factory = RepoFactory.from_template(self.repo_store, num_commits=4)
         commits_from = factory.commits[2].hex
-        resp = self.app.get(f"/repo/{self.repo_path}/log/{commits_from}")
+        resp = self.app.get(f"{self.repo_url}/log/{commits_from}")
         self.assertEqual(3, len(resp.json))
 
     def test_repo_get_unicode_log(self):
@@ -1201,7 +1245,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         oid = factory.add_commit(message, "자장면/짜장면.py")
         oid2 = factory.add_commit(message2, "엄마야!.js", [oid])
 
-        resp = self.app.get(f"/repo/{self.repo_path}/log/{oid2}")
+        resp = self.app.get(f"{self.repo_url}/log/{oid2}")
         self.assertEqual(
             message2.decode("utf-8", "replace"), resp.json[0]["message"]
         )
@@ -1214,29 +1258,31 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         factory = RepoFactory(self.repo_store)
         message = b"\xe9\xe9\xe9"  # latin-1
         oid = factory.add_commit(message, "foo.py")
-        resp = self.app.get(f"/repo/{self.repo_path}/log/{oid}")
+        resp = self.app.get(f"{self.repo_url}/log/{oid}")
         self.assertEqual(
             message.decode("utf-8", "replace"), resp.json[0]["message"]
         )
 
     def test_repo_get_log_with_limit(self):
         """Ensure the commit log can filtered by limit."""
-        factory = RepoFactory(self.repo_store, num_commits=10)
-        repo = factory.build()
+        factory = RepoFactory.from_template(
+            self.repo_store, num_commits=10, pack=True
+        )
+        repo = factory.repo
         head = repo.head.target
-        resp = self.app.get(f"/repo/{self.repo_path}/log/{head}?limit=5")
+        resp = self.app.get(f"{self.repo_url}/log/{head}?limit=5")
         self.assertEqual(5, len(resp.json))
 
     def test_repo_get_log_with_stop(self):
         """Ensure the commit log can be filtered by a stop commit."""
-        factory = RepoFactory(self.repo_store, num_commits=10)
-        repo = factory.build()
+        factory = RepoFactory.from_template(
+            self.repo_store, num_commits=10, pack=True
+        )
+        repo = factory.repo
         stop_commit = factory.commits[4]
         excluded_commit = factory.commits[5]
         head = repo.head.target
-        resp = self.app.get(
-            f"/repo/{self.repo_path}/log/{head}?stop={stop_commit}"
-        )
+        resp = self.app.get(f"{self.repo_url}/log/{head}?stop={stop_commit}")
         self.assertEqual(5, len(resp.json))
         self.assertNotIn(excluded_commit, resp.json)
 
@@ -1244,7 +1290,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         """Ensure commit exists in pack."""
         factory = RepoFactory(self.repo_store, num_branches=2, num_commits=1)
         factory.build()
-        resp = self.app.post_json(f"/repo/{self.repo_path}/repack")
+        resp = self.app.post_json(f"{self.repo_url}/repack")
         self.assertEqual(200, resp.status_code)
         # test for nonexistent repositories
         resp = self.app.post_json(
@@ -1255,7 +1301,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
     def test_repo_gc(self):
         factory = RepoFactory(self.repo_store, num_branches=2, num_commits=1)
         factory.build()
-        resp = self.app.post_json(f"/repo/{self.repo_path}/gc")
+        resp = self.app.post_json(f"{self.repo_url}/gc")
         self.assertEqual(200, resp.status_code)
         # test for nonexistent repositories
         resp = self.app.post_json("/repo/nonexistent/gc", expect_errors=True)
@@ -1265,8 +1311,8 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         """A non-existent target OID returns HTTP 404."""
         factory = RepoFactory(self.repo_store)
         resp = self.app.post_json(
-            "/repo/{}/detect-merges/{}".format(
-                self.repo_path, factory.nonexistent_oid()
+            "{}/detect-merges/{}".format(
+                self.repo_url, factory.nonexistent_oid()
             ),
             {"sources": []},
             expect_errors=True,
@@ -1280,7 +1326,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         a = factory.add_commit("a\n", "file")
         b = factory.add_commit("b\n", "file", parents=[a])
         resp = self.app.post_json(
-            f"/repo/{self.repo_path}/detect-merges/{b}",
+            f"{self.repo_url}/detect-merges/{b}",
             {"sources": [factory.nonexistent_oid()]},
         )
         self.assertEqual(200, resp.status_code)
@@ -1296,7 +1342,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         b = factory.add_commit("b\n", "file", parents=[a])
         c = factory.add_commit("c\n", "file", parents=[a])
         resp = self.app.post_json(
-            f"/repo/{self.repo_path}/detect-merges/{b}",
+            f"{self.repo_url}/detect-merges/{b}",
             {"sources": [c.hex]},
         )
         self.assertEqual(200, resp.status_code)
@@ -1313,7 +1359,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         # The start commit would never be the source of a merge proposal,
         # but include it anyway to test boundary conditions.
         resp = self.app.post_json(
-            f"/repo/{self.repo_path}/detect-merges/{c}",
+            f"{self.repo_url}/detect-merges/{c}",
             {"sources": [a.hex, b.hex, c.hex]},
         )
         self.assertEqual(200, resp.status_code)
@@ -1335,7 +1381,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         h = factory.add_commit("h\n", "file", parents=[g])
         i = factory.add_commit("i\n", "file", parents=[f])
         resp = self.app.post_json(
-            f"/repo/{self.repo_path}/detect-merges/{h}",
+            f"{self.repo_url}/detect-merges/{h}",
             {"sources": [b.hex, e.hex, i.hex]},
         )
         self.assertEqual(200, resp.status_code)
@@ -1361,13 +1407,13 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         h = factory.add_commit("h\n", "file", parents=[g])
         i = factory.add_commit("i\n", "file", parents=[f])
         resp = self.app.post_json(
-            f"/repo/{self.repo_path}/detect-merges/{h}",
+            f"{self.repo_url}/detect-merges/{h}",
             {"sources": [b.hex, e.hex, i.hex], "stop": [c.hex]},
         )
         self.assertEqual(200, resp.status_code)
         self.assertEqual({e.hex: g.hex}, resp.json)
         resp = self.app.post_json(
-            f"/repo/{self.repo_path}/detect-merges/{h}",
+            f"{self.repo_url}/detect-merges/{h}",
             {"sources": [b.hex, e.hex, i.hex], "stop": [c.hex, g.hex]},
         )
         self.assertEqual(200, resp.status_code)
@@ -1378,15 +1424,13 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         factory = RepoFactory(self.repo_store)
         c1 = factory.add_commit("a\n", "dir/file")
         factory.add_commit("b\n", "dir/file", parents=[c1])
-        resp = self.app.get(f"/repo/{self.repo_path}/blob/dir/file")
+        resp = self.app.get(f"{self.repo_url}/blob/dir/file")
         self.assertEqual(2, resp.json["size"])
         self.assertEqual(b"b\n", base64.b64decode(resp.json["data"]))
-        resp = self.app.get(f"/repo/{self.repo_path}/blob/dir/file?rev=master")
+        resp = self.app.get(f"{self.repo_url}/blob/dir/file?rev=master")
         self.assertEqual(2, resp.json["size"])
         self.assertEqual(b"b\n", base64.b64decode(resp.json["data"]))
-        resp = self.app.get(
-            f"/repo/{self.repo_path}/blob/dir/file?rev={c1.hex}"
-        )
+        resp = self.app.get(f"{self.repo_url}/blob/dir/file?rev={c1.hex}")
         self.assertEqual(2, resp.json["size"])
         self.assertEqual(b"a\n", base64.b64decode(resp.json["data"]))
 
@@ -1395,8 +1439,8 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         factory = RepoFactory(self.repo_store)
         factory.add_commit("a\n", "dir/file")
         resp = self.app.get(
-            "/repo/{}/blob/dir/file?rev={}".format(
-                self.repo_path, factory.nonexistent_oid()
+            "{}/blob/dir/file?rev={}".format(
+                self.repo_url, factory.nonexistent_oid()
             ),
             expect_errors=True,
         )
@@ -1407,7 +1451,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         factory = RepoFactory(self.repo_store)
         factory.add_commit("a\n", "dir/file")
         resp = self.app.get(
-            f"/repo/{self.repo_path}/blob/nonexistent",
+            f"{self.repo_url}/blob/nonexistent",
             expect_errors=True,
         )
         self.assertEqual(404, resp.status_code)
@@ -1416,16 +1460,14 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         """Trying to get a blob referring to a directory returns HTTP 404."""
         factory = RepoFactory(self.repo_store)
         factory.add_commit("a\n", "dir/file")
-        resp = self.app.get(
-            f"/repo/{self.repo_path}/blob/dir", expect_errors=True
-        )
+        resp = self.app.get(f"{self.repo_url}/blob/dir", expect_errors=True)
         self.assertEqual(404, resp.status_code)
 
     def test_repo_blob_non_ascii(self):
         """Blobs may contain non-ASCII (and indeed non-UTF-8) data."""
         factory = RepoFactory(self.repo_store)
         factory.add_commit(b"\x80\x81\x82\x83", "dir/file")
-        resp = self.app.get(f"/repo/{self.repo_path}/blob/dir/file")
+        resp = self.app.get(f"{self.repo_url}/blob/dir/file")
         self.assertEqual(4, resp.json["size"])
         self.assertEqual(
             b"\x80\x81\x82\x83", base64.b64decode(resp.json["data"])
@@ -1437,9 +1479,7 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         c1 = factory.add_commit("a\n", "dir/file")
         factory.add_commit("b\n", "dir/file", parents=[c1])
         factory.add_tag("tag-name", "tag message", c1)
-        resp = self.app.get(
-            f"/repo/{self.repo_path}/blob/dir/file?rev=tag-name"
-        )
+        resp = self.app.get(f"{self.repo_url}/blob/dir/file?rev=tag-name")
         self.assertEqual(2, resp.json["size"])
         self.assertEqual(b"a\n", base64.b64decode(resp.json["data"]))
 
@@ -1449,8 +1489,8 @@ class ApiTestCase(TestCase, ApiRepoStoreMixin):
         c1 = factory.add_commit("a\n", "dir/file")
         factory.add_commit("b\n", "dir/file", parents=[c1])
         resp = self.app.get(
-            "/repo/{}/blob/dir/file?rev={}".format(
-                self.repo_path, factory.repo[c1].tree.hex
+            "{}/blob/dir/file?rev={}".format(
+                self.repo_url, factory.repo[c1].tree.hex
             ),
             expect_errors=True,
         )
@@ -1469,7 +1509,11 @@ class AsyncRepoCreationAPI(TestCase, ApiRepoStoreMixin):
         self.virtinfo_port = self.virtinfo_listener.getHost().port
         self.virtinfo_url = b"http://localhost:%d/" % self.virtinfo_port
         self.addCleanup(self.virtinfo_listener.stopListening)
-        config.defaults["virtinfo_endpoint"] = self.virtinfo_url
+        patcher = mock.patch.dict(
+            config.defaults, {"virtinfo_endpoint": self.virtinfo_url}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def _doReactorIteration(self):
         """Yield to the reactor so it can process virtinfo requests.
@@ -1530,7 +1574,7 @@ class AsyncRepoCreationAPI(TestCase, ApiRepoStoreMixin):
 
         factory = RepoFactory(self.repo_store, num_commits=2)
         factory.build()
-        new_repo_path = uuid.uuid1().hex
+        new_repo_path = unique_name()
         resp = self.app.post_json(
             "/repo",
             {
@@ -1576,7 +1620,7 @@ class AsyncRepoCreationAPI(TestCase, ApiRepoStoreMixin):
 
         factory = RepoFactory(self.repo_store, num_commits=2)
         factory.build()
-        new_repo_path = uuid.uuid1().hex
+        new_repo_path = unique_name()
         self.app.post_json(
             "/repo",
             {
@@ -1622,7 +1666,7 @@ class AsyncRepoCreationAPI(TestCase, ApiRepoStoreMixin):
 
         factory = RepoFactory(self.repo_store, num_commits=2)
         factory.build()
-        new_repo_path = uuid.uuid1().hex
+        new_repo_path = unique_name()
         self.app.post_json(
             "/repo",
             {
@@ -1673,7 +1717,7 @@ class AsyncRepoCreationAPI(TestCase, ApiRepoStoreMixin):
 
         factory = RepoFactory(self.repo_store, num_commits=2)
         factory.build()
-        new_repo_path = uuid.uuid1().hex
+        new_repo_path = unique_name()
         self.app.post_json(
             "/repo",
             {
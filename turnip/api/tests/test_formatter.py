@@ -0,0 +1,32 @@
+# Copyright 2026 Canonical Ltd.  This software is licensed under the
+# GNU Affero General Public License version 3 (see the file LICENSE).
+
+import json
+
+from testtools import TestCase
+
+from turnip.api.formatter import iter_json
+
+
+class IterJSONTestCase(TestCase):
+    def test_list(self):
+        value = [{"sha1": str(i)} for i in range(5)]
+        chunks = list(iter_json(value, batch_size=2))
+        self.assertEqual(5, len(chunks))
+        self.assertEqual(value, json.loads(b"".join(chunks)))
+
+    def test_dict(self):
+        value = {f"refs/heads/{i}": {"object": i} for i in range(5)}
+        chunks = list(iter_json(value, batch_size=2))
+        self.assertEqual(5, len(chunks))
+        self.assertEqual(value, json.loads(b"".join(chunks)))
+
+    def test_empty(self):
+        self.assertEqual(b"[]", b"".join(iter_json([])))
+        self.assertEqual(b"{}", b"".join(iter_json({})))
+
+    def test_default(self):
+        value = [{"data": b"Zm9v"}]
+        self.assertRaises(TypeError, b"".join, iter_json(value))
+        chunks = iter_json(value, default=lambda obj: obj.decode("UTF-8"))
+        self.assertEqual([{"data": "Zm9v"}], json.loads(b"".join(chunks)))
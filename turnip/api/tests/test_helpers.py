@@ -1,19 +1,22 @@
 # Copyright 2015 Canonical Ltd.  This software is licensed under the
 # GNU Affero General Public License version 3 (see the file LICENSE).
 
+import atexit
 import contextlib
-import fnmatch
+import functools
 import itertools
 import logging
 import os
-import uuid
-from subprocess import PIPE, STDOUT, CalledProcessError, Popen
+import shutil
+import tempfile
+from subprocess import PIPE, STDOUT, CalledProcessError, Popen, run
 from urllib.parse import urljoin
 from urllib.request import pathname2url
 
 import six
 from pygit2 import (
     GIT_FILEMODE_BLOB,
+    GIT_OBJ_COMMIT,
     IndexEntry,
     Repository,
     Signature,
@@ -23,14 +26,60 @@ from pygit2 import (
 
 log = logging.getLogger()
 
+# Root for temporary repository stores.  This defaults to the system
+# temporary directory (honouring $TMPDIR); set TURNIP_TEST_TEMP_ROOT to use
+# somewhere else, such as a RAM-backed filesystem like /dev/shm.
+TEMP_ROOT = os.environ.get("TURNIP_TEST_TEMP_ROOT") or None
+
+AUTHOR = Signature("Test Author", "author@bar.com")
+COMMITTER = Signature("Test Committer", "committer@bar.com")
+
+# Template repositories built by RepoFactory.from_template, keyed by the
+# factory arguments used to build them.
+_templates = {}
+_template_root = None
+
+
+def _get_template_root():
+    """Return a directory for template repositories, creating it once."""
+    global _template_root
+    if _template_root is None:
+        _template_root = tempfile.mkdtemp(dir=TEMP_ROOT)
+        atexit.register(shutil.rmtree, _template_root, ignore_errors=True)
+    return _template_root
+
+
+_name_counter = itertools.count()
+# Makes generated blobs (and so commits) unique across factories.
+_blob_counter = itertools.count()
+
+
+def unique_name(prefix="repo"):
+    """Return a name that is unique across test processes in this run."""
+    return f"{prefix}-{os.getpid()}-{next(_name_counter)}"
+
+
+def _link_or_copy(src, dst):
+    """Hard-link src to dst, falling back to copying it."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
 
 def get_revlist(repo):
     """Return revlist for a given pygit2 repo object."""
-    return [commit.oid.hex for commit in repo.walk(repo.head.target)]
+    head_target = repo.head.target
+    return [commit.oid.hex for commit in repo.walk(head_target)]
 
 
+@functools.lru_cache(maxsize=32)
 def open_repo(repo_path):
-    """Return a pygit2 repo object for a given path."""
+    """Return a pygit2 repo object for a given path.
+
+    Repository objects are cached by path; tests should clear the cache
+    with open_repo.cache_clear() when they finish.
+    """
     return Repository(repo_path)
 
 
@@ -55,14 +104,16 @@ class RepoFactory:
         num_branches=None,
         num_tags=None,
         clone_from=None,
+        pack=False,
     ):
-        self.author = Signature("Test Author", "author@bar.com")
+        self.author = AUTHOR
         self.branches = []
         self.commits = []
-        self.committer = Signature("Test Committer", "committer@bar.com")
+        self.committer = COMMITTER
         self.num_branches = num_branches
         self.num_commits = num_commits
         self.num_tags = num_tags
+        self.pack = pack
         self.repo_path = repo_path
         self.pack_dir = os.path.join(repo_path, "objects", "pack")
         if clone_from:
@@ -70,25 +121,74 @@ class RepoFactory:
         else:
             self.repo = self.init_repo()
 
+    @classmethod
+    def from_template(cls, repo_path, link_objects=True, **kwargs):
+        """Return a factory for a copy of a cached, already built repo.
+
+        The template repository is built once per set of arguments and
+        then copied to repo_path, which is much cheaper than building an
+        identical repository from scratch for every test.  Git never
+        modifies object files in place, so unless link_objects is false
+        they are hard-linked from the template rather than copied.
+        """
+        key = tuple(sorted(kwargs.items()))
+        template = _templates.get(key)
+        if template is None:
+            template_path = os.path.join(
+                _get_template_root(), str(len(_templates))
+            )
+            template = cls(template_path, **kwargs)
+            template.build()
+            _templates[key] = template
+        if link_objects:
+
+            def ignore_objects(src, names):
+                # Only skip the top-level objects directory, not refs or
+                # other paths that happen to be called "objects".
+                if os.path.samefile(src, template.repo_path):
+                    return {"objects"}
+                return set()
+
+            shutil.copytree(
+                template.repo_path, repo_path, ignore=ignore_objects
+            )
+            shutil.copytree(
+                os.path.join(template.repo_path, "objects"),
+                os.path.join(repo_path, "objects"),
+                copy_function=_link_or_copy,
+            )
+        else:
+            shutil.copytree(template.repo_path, repo_path)
+        factory = cls(repo_path, **kwargs)
+        factory.commits = list(template.commits)
+        factory.branches = [
+            factory.repo.branches[branch.branch_name]
+            for branch in template.branches
+        ]
+        return factory
+
     @property
     def packs(self):
         """Return list of pack files."""
         return [
             filename
-            for filename in fnmatch.filter(os.listdir(self.pack_dir), "*.pack")
+            for filename in os.listdir(self.pack_dir)
+            if filename.endswith(".pack")
         ]
 
     def add_commit(
         self,
         blob_content,
         file_path,
-        parents=[],
+        parents=None,
         ref=None,
         author=None,
         committer=None,
     ):
         """Create a commit from blob_content and file_path."""
         repo = self.repo
+        if parents is None:
+            parents = []
         if not author:
             author = self.author
         if not committer:
@@ -132,6 +232,20 @@ class RepoFactory:
 
     def add_tag(self, tag_name, tag_message, oid):
         """Create a tag from tag_name and oid."""
+        try:
+            tag_name = six.ensure_text(tag_name)
+            tag_message = six.ensure_text(tag_message)
+        except UnicodeDecodeError:
+            # pygit2 only accepts text tag names and messages, so let git
+            # itself create tags that are not valid UTF-8.
+            self._git_tag(tag_name, tag_message, oid)
+        else:
+            self.repo.create_tag(
+                tag_name, oid, GIT_OBJ_COMMIT, self.committer, tag_message
+            )
+
+    def _git_tag(self, tag_name, tag_message, oid):
+        """Create a tag from tag_name and oid using the git CLI."""
         cmd_line = ["git", "-C", self.repo_path]
         cmd_line += self._get_cmd_line_auth_params()
         cmd_line += ["tag", "-m", tag_message, tag_name, oid.hex]
@@ -161,27 +275,41 @@ class RepoFactory:
         )
         return self.repo.index.write_tree()
 
-    def generate_commits(self, num_commits, parents=[]):
+    def _single_entry_tree(self, path, content):
+        """Write a tree holding only content at path and return its id.
+
+        Unlike stage, this bypasses the index, so the tree does not
+        include files from earlier commits.
+        """
+        tree_builder = self.repo.TreeBuilder()
+        tree_builder.insert(
+            path, self.repo.create_blob(content), GIT_FILEMODE_BLOB
+        )
+        return tree_builder.write()
+
+    def generate_commits(self, num_commits, parents=None):
         """Generate n number of commits."""
+        repo = self.repo
+        if parents is None:
+            parents = []
+        test_file = "test.txt"
         for i in range(num_commits):
-            blob_content = (
-                b"commit "
-                + str(i).encode("ascii")
-                + b" - "
-                + uuid.uuid1().hex.encode("ascii")
+            blob_content = b"commit %d - %d" % (i, next(_blob_counter))
+            tree_id = self._single_entry_tree(test_file, blob_content)
+            commit_oid = repo.create_commit(
+                None,
+                self.author,
+                self.committer,
+                blob_content,
+                tree_id,
+                parents,
             )
-            test_file = "test.txt"
-            self.stage(test_file, blob_content)
-            commit_oid = self.add_commit(blob_content, test_file, parents)
             self.commits.append(commit_oid)
             parents = [commit_oid]
-            if i == num_commits - 1:
-                ref = "refs/heads/master"
-                try:
-                    self.repo.references[ref]
-                except KeyError:
-                    self.repo.references.create(ref, commit_oid)
-                self.repo.set_head(commit_oid)
+        if num_commits:
+            # Only the last commit needs to update master and HEAD.
+            self.set_head(commit_oid)
+            repo.set_head(commit_oid)
 
     def generate_tags(self, num_tags):
         """Generate n number of tags."""
@@ -203,11 +331,14 @@ class RepoFactory:
 
     def nonexistent_oid(self):
         """Return an arbitrary OID that does not exist in this repo."""
-        for oid_chars in itertools.product("0123456789abcdef", repeat=40):
-            oid = "".join(oid_chars)
+        while True:
+            oid = os.urandom(20).hex()
             if oid not in self.repo:
                 return oid
-        raise Exception("repo appears to contain every possible OID!")
+
+    def repack(self):
+        """Pack all objects, as a long-lived repository would be."""
+        run(["git", "-C", self.repo_path, "repack", "-adq"], check=True)
 
     def init_repo(self):
         return init_repository(self.repo_path, bare=True)
@@ -218,11 +349,17 @@ class RepoFactory:
         return clone_repository(clone_from_url, self.repo_path, bare=False)
 
     def build(self):
-        """Return a repo, optionally with generated commits and tags."""
+        """Return a repo, optionally with generated commits and tags.
+
+        If the factory was created with pack=True, the loose objects are
+        packed once everything has been generated.
+        """
         if self.num_branches:
             self.generate_branches(self.num_branches, self.num_commits)
         if not self.num_branches and self.num_commits:
             self.generate_commits(self.num_commits)
         if self.num_tags:
             self.generate_tags(self.num_tags)
+        if self.pack:
+            self.repack()
         return self.repo
@@ -1,10 +1,11 @@
 # Copyright 2015 Canonical Ltd.  This software is licensed under the
 # GNU Affero General Public License version 3 (see the file LICENSE).
 
+import functools
 import os.path
-import re
 import subprocess
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import pygit2
 import yaml
@@ -12,40 +13,96 @@ from fixtures import EnvironmentVariable, MonkeyPatch, TempDir
 from testtools import TestCase
 
 from turnip.api import store
-from turnip.api.tests.test_helpers import RepoFactory, open_repo
+from turnip.api.tests.test_helpers import (
+    TEMP_ROOT,
+    RepoFactory,
+    open_repo,
+    unique_name,
+)
+from turnip.pack.helpers import YAML_SAFE_LOADER
 from turnip.tests.tasks import CeleryWorkerFixture
 
 
+@functools.lru_cache(maxsize=None)
+def get_git_config_yaml():
+    """Return the parsed git.config.yaml, loading it only once."""
+    with open("git.config.yaml") as f:
+        return yaml.load(f, Loader=YAML_SAFE_LOADER)
+
+
 class InitTestCase(TestCase):
     def setUp(self):
         super().setUp()
-        self.repo_store = self.useFixture(TempDir()).path
+        self.repo_store = self.useFixture(TempDir(rootdir=TEMP_ROOT)).path
         self.useFixture(EnvironmentVariable("REPO_STORE", self.repo_store))
+        self.addCleanup(open_repo.cache_clear)
+
+    def _walkFiles(self, path):
+        """Yield a DirEntry for each file below path."""
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self._walkFiles(entry.path)
+                else:
+                    yield entry
+
+    def makeRepos(self, names, **kwargs):
+        """Build independent repositories concurrently.
+
+        :return: A dict mapping each name to the repository built at that
+            name in the repository store.
+        """
+
+        def make_repo(name):
+            path = os.path.join(self.repo_store, name)
+            return RepoFactory(path, **kwargs).build()
+
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            return dict(zip(names, executor.map(make_repo, names)))
+
+    def assertObjectsPresent(self, oids, repo):
+        """Assert that all of oids are in repo, reporting any missing."""
+        self.assertEqual([], [oid for oid in oids if oid not in repo])
 
     def assertAllLinkCounts(self, link_count, path):
         count = 0
-        for dirpath, _, filenames in os.walk(path):
-            for filename in filenames:
-                count += 1
-                self.assertEqual(
-                    link_count,
-                    os.stat(os.path.join(dirpath, filename)).st_nlink,
-                )
+        for entry in self._walkFiles(path):
+            count += 1
+            self.assertEqual(
+                link_count, entry.stat(follow_symlinks=False).st_nlink
+            )
         return count
 
     def assertAdvertisedRefs(self, present, absent, repo_path):
-        out, err = subprocess.Popen(
+        """Assert which refs git receive-pack advertises for a repository.
+
+        :param present: (ref, hex) pairs that must be advertised.
+        :param absent: (ref, hex) pairs, or bare ref name prefixes, that
+            must not be advertised.
+        """
+        result = subprocess.run(
             ["git", "receive-pack", "--advertise-refs", repo_path],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        ).communicate()
-        self.assertEqual(b"", err)
-        for ref, hex in present:
-            self.assertIn(
-                hex.encode("ascii") + b" " + ref.encode("utf-8"), out
-            )
-        for ref in absent:
-            self.assertNotIn(absent, out)
+            capture_output=True,
+            check=True,
+        )
+        self.assertEqual(b"", result.stderr)
+        out = result.stdout
+
+        def needle(entry):
+            if isinstance(entry, tuple):
+                ref, hex = entry
+                entry = f"{hex} {ref}"
+            return entry.encode()
+
+        present_needles = [needle(entry) for entry in present]
+        absent_needles = [needle(entry) for entry in absent]
+        # Report all missing and all unexpected refs at once.
+        self.assertEqual(
+            [], [needle for needle in present_needles if needle not in out]
+        )
+        self.assertEqual(
+            [], [needle for needle in absent_needles if needle in out]
+        )
 
     def assertPackedRefs(self, refs, repo_path):
         """Assert the exact format of a packed-refs file.
@@ -79,12 +136,15 @@ class InitTestCase(TestCase):
         alt_path = store.alternates_path(repo_path)
         if not os.path.exists(os.path.dirname(alt_path)):
             raise Exception("No repo at %s." % repo_path)
-        actual_paths = []
-        if os.path.exists(alt_path):
+        try:
             with open(alt_path) as altf:
-                actual_paths = [
-                    re.sub("/objects\n$", "", line) for line in altf
-                ]
+                lines = altf.read().splitlines()
+        except FileNotFoundError:
+            lines = []
+        actual_paths = [
+            line[: -len("/objects")] if line.endswith("/objects") else line
+            for line in lines
+        ]
         self.assertEqual(
             {path.rstrip("/") for path in expected_paths},
             set(actual_paths),
@@ -92,33 +152,40 @@ class InitTestCase(TestCase):
 
     def makeOrig(self):
         self.orig_path = os.path.join(self.repo_store, "orig/")
-        self.orig_factory = RepoFactory(
-            self.orig_path, num_branches=3, num_commits=2, num_tags=2
+        # Copy rather than hard-link objects, since tests check the link
+        # counts of the original repository's objects.
+        self.orig_factory = RepoFactory.from_template(
+            self.orig_path,
+            link_objects=False,
+            num_branches=3,
+            num_commits=2,
+            num_tags=2,
         )
-        orig = self.orig_factory.build()
+        orig = self.orig_factory.repo
         self.orig_refs = {}
         for ref in orig.references.objects:
             obj = orig[ref.target]
             self.orig_refs[ref.name] = (
                 obj.hex,
-                ref.peel().hex if obj.type != pygit2.GIT_OBJ_COMMIT else None,
+                ref.peel().hex if obj.type == pygit2.GIT_OBJ_TAG else None,
             )
         self.master_oid = orig.references["refs/heads/master"].target
-        self.orig_objs = os.path.join(self.orig_path, ".git/objects")
+        self.orig_objs = os.path.join(self.orig_path, "objects")
 
     def test_from_scratch(self):
         path = os.path.join(self.repo_store, "repo/")
         store.init_repo(path)
-        r = pygit2.Repository(path)
+        r = open_repo(path)
         self.assertEqual([], r.listall_references())
 
     def test_repo_config(self):
         """Assert repository is initialised with correct config defaults."""
         repo_path = os.path.join(self.repo_store, "repo")
         store.init_repo(repo_path)
-        repo_config = pygit2.Repository(repo_path).config
-        with open("git.config.yaml") as f:
-            yaml_config = yaml.safe_load(f)
+        # Read the repository's own config file without opening the
+        # repository itself.
+        repo_config = pygit2.Config(os.path.join(repo_path, "config"))
+        yaml_config = get_git_config_yaml()
 
         self.assertEqual(
             bool(yaml_config["core.logallrefupdates"]),
@@ -155,16 +222,12 @@ class InitTestCase(TestCase):
         # Create repos A and B with distinct commits, and C which has no
         # objects of its own but has a clone of B as its
         # turnip-subordinate.
-        repos = {}
-        for name in ["A", "B"]:
-            factory = RepoFactory(os.path.join(self.repo_store, name))
-            factory.generate_branches(2, 2)
-            repos[name] = factory.repo
+        repos = self.makeRepos(["A", "B"], num_branches=2, num_commits=2)
         repo_path_c = os.path.join(self.repo_store, "C")
         store.init_repo(
             repo_path_c, clone_from=os.path.join(self.repo_store, "B")
         )
-        repos["C"] = pygit2.Repository(repo_path_c)
+        repos["C"] = open_repo(repo_path_c)
 
         # Opening the union of one and three includes the objects from
         # two, as they're in three's turnip-subordinate.
@@ -180,14 +243,15 @@ class InitTestCase(TestCase):
                 ],
                 ephemeral_repo.path,
             )
-            self.assertIn(repos["A"].head.target, ephemeral_repo)
-            self.assertIn(repos["B"].head.target, ephemeral_repo)
+            self.assertObjectsPresent(
+                [repos["A"].head.target, repos["B"].head.target],
+                ephemeral_repo,
+            )
 
     def test_open_ephemeral_repo_already_exists(self):
         """If an ephemeral repo already exists, open_repo fails correctly."""
-        repos = {}
         for name in ("A", "B"):
-            repos[name] = RepoFactory(os.path.join(self.repo_store, name)).repo
+            RepoFactory(os.path.join(self.repo_store, name))
         ephemeral_uuid = uuid.uuid4()
         self.useFixture(MonkeyPatch("uuid.uuid4", lambda: ephemeral_uuid))
         ephemeral_path = os.path.join(
@@ -222,9 +286,8 @@ class InitTestCase(TestCase):
                 "turnip.api.store.write_alternates", mock_write_alternates
             )
         )
-        repos = {}
         for name in ("A", "B"):
-            repos[name] = RepoFactory(os.path.join(self.repo_store, name)).repo
+            RepoFactory(os.path.join(self.repo_store, name))
 
         def open_test_repo():
             with store.open_repo(self.repo_store, "A:B"):
@@ -235,8 +298,8 @@ class InitTestCase(TestCase):
 
     def test_repo_with_alternates(self):
         """Ensure objects path is defined correctly in repo alternates."""
-        factory = RepoFactory(os.path.join(self.repo_store, uuid.uuid1().hex))
-        repo_path_with_alt = os.path.join(self.repo_store, uuid.uuid1().hex)
+        factory = RepoFactory(os.path.join(self.repo_store, unique_name()))
+        repo_path_with_alt = os.path.join(self.repo_store, unique_name())
         store.init_repo(
             repo_path_with_alt, alternate_repo_paths=[factory.repo.path]
         )
@@ -244,9 +307,9 @@ class InitTestCase(TestCase):
 
     def test_repo_alternates_objects_shared(self):
         """Ensure objects are shared from alternate repo."""
-        factory = RepoFactory(os.path.join(self.repo_store, uuid.uuid1().hex))
+        factory = RepoFactory(os.path.join(self.repo_store, unique_name()))
         commit_oid = factory.add_commit("foo", "foobar.txt")
-        repo_path_with_alt = os.path.join(self.repo_store, uuid.uuid4().hex)
+        repo_path_with_alt = os.path.join(self.repo_store, unique_name())
         store.init_repo(
             repo_path_with_alt, alternate_repo_paths=[factory.repo.path]
         )
@@ -265,11 +328,9 @@ class InitTestCase(TestCase):
         store.init_repo(to_path, clone_from=self.orig_path, clone_refs=True)
         self.assertTrue(store.is_repository_available(to_path))
 
-        to = pygit2.Repository(to_path)
+        to = open_repo(to_path)
         self.assertIsNot(None, to[self.master_oid])
-        self.assertEqual(
-            sorted(self.orig_refs), sorted(to.listall_references())
-        )
+        self.assertEqual(set(self.orig_refs), set(to.references))
         self.assertPackedRefs(self.orig_refs, to_path)
 
         # Advance master and remove branch-2, so that the commit referenced
@@ -309,7 +370,7 @@ class InitTestCase(TestCase):
         store.init_repo(to_path, clone_from=self.orig_path, clone_refs=False)
         self.assertTrue(store.is_repository_available(to_path))
 
-        to = pygit2.Repository(to_path)
+        to = open_repo(to_path)
         self.assertIsNot(None, to[self.master_oid])
         self.assertEqual([], to.listall_references())
         self.assertFalse(os.path.exists(os.path.join(to_path, "packed-refs")))
@@ -330,7 +391,7 @@ class InitTestCase(TestCase):
 
     def test_clone_of_clone(self):
         self.makeOrig()
-        orig = pygit2.Repository(self.orig_path)
+        orig = self.orig_factory.repo
         orig_blob = orig.create_blob(b"orig")
 
         self.assertAllLinkCounts(1, self.orig_objs)
@@ -340,47 +401,33 @@ class InitTestCase(TestCase):
         self.assertTrue(store.is_repository_available(to_path))
 
         self.assertAllLinkCounts(2, self.orig_objs)
-        to = pygit2.Repository(to_path)
+        to = open_repo(to_path)
         to_blob = to.create_blob(b"to")
-        to.create_branch(
-            "branch-0",
-            orig[orig.references["refs/heads/branch-1"].target.hex],
-            True,
-        )
-        to.create_branch(
-            "new-branch",
-            orig[orig.references["refs/heads/branch-1"].target.hex],
-        )
+        branch_1_hex = orig.references["refs/heads/branch-1"].target.hex
+        to.create_branch("branch-0", to[branch_1_hex], True)
+        to.create_branch("new-branch", to[branch_1_hex])
         packed_refs = dict(self.orig_refs)
-        packed_refs["refs/heads/branch-0"] = (
-            orig.references["refs/heads/branch-1"].target.hex,
-            None,
-        )
-        packed_refs["refs/heads/new-branch"] = (
-            orig.references["refs/heads/branch-1"].target.hex,
-            None,
-        )
+        packed_refs["refs/heads/branch-0"] = (branch_1_hex, None)
+        packed_refs["refs/heads/new-branch"] = (branch_1_hex, None)
 
         too_path = os.path.join(self.repo_store, "too/")
         store.init_repo(too_path, clone_from=to_path)
         self.assertAllLinkCounts(3, self.orig_objs)
-        too_blob = pygit2.Repository(too_path).create_blob(b"too")
+        too = open_repo(too_path)
+        too_blob = too.create_blob(b"too")
 
         # Each clone has just its subordinate as an alternate, and the
         # subordinate has no alternates of its own.
-        for path in (to_path, too_path):
+        for path, repo in ((to_path, to), (too_path, too)):
             self.assertAlternates(["../turnip-subordinate"], path)
             self.assertAlternates([], os.path.join(path, "turnip-subordinate"))
-            self.assertIn(self.master_oid.hex, pygit2.Repository(path))
+            self.assertIn(self.master_oid.hex, repo)
             self.assertAdvertisedRefs(
                 [(".have", self.master_oid.hex)], [], path
             )
 
         # Objects from all three repos are in the third.
-        too = pygit2.Repository(too_path)
-        self.assertIn(orig_blob, too)
-        self.assertIn(to_blob, too)
-        self.assertIn(too_blob, too)
+        self.assertObjectsPresent([orig_blob, to_blob, too_blob], too)
 
         # Each clone has refs from its (transitive) parents in its
         # subordinate.
@@ -392,7 +439,7 @@ class InitTestCase(TestCase):
         )
 
     def test_create_single_ref(self):
-        repo_path = os.path.join(self.repo_store, uuid.uuid1().hex)
+        repo_path = os.path.join(self.repo_store, unique_name())
         factory = RepoFactory(repo_path)
         commit_sha1 = factory.add_commit("foo", "foobar.txt").hex
         tag_name = "refs/tags/1701"
@@ -407,7 +454,7 @@ class InitTestCase(TestCase):
             self.assertAdvertisedRefs([(ref, commit_sha1)], [], repo_path)
 
     def test_create_multiple_mixed_success_and_errors(self):
-        repo_path = os.path.join(self.repo_store, uuid.uuid1().hex)
+        repo_path = os.path.join(self.repo_store, unique_name())
         factory = RepoFactory(repo_path)
 
         expected_created = []
@@ -485,11 +532,16 @@ class InitTestCase(TestCase):
         )
 
         # Verify successful cases are created and errorneous ones are not
-        # on the git level
-        self.assertAdvertisedRefs(expected_created, expected_errors, repo_path)
+        # on the git level.  The already existing ref is still advertised,
+        # pointing at its original commit.
+        self.assertAdvertisedRefs(
+            expected_created,
+            [error for error in expected_errors if error[0] != existing_ref],
+            repo_path,
+        )
 
     def test_force_overwrite_ref(self):
-        repo_path = os.path.join(self.repo_store, uuid.uuid1().hex)
+        repo_path = os.path.join(self.repo_store, unique_name())
         factory = RepoFactory(repo_path)
         first_commit_sha1 = factory.add_commit("foo", "foobar.txt").hex
         tag_name = "refs/tags/1701"
@@ -540,8 +592,8 @@ class InitTestCase(TestCase):
         dest_path = os.path.join(self.repo_store, "to/")
         store.init_repo(dest_path, clone_from=self.orig_path)
 
-        dest = pygit2.Repository(dest_path)
-        self.assertEqual([], dest.references.objects)
+        dest = open_repo(dest_path)
+        self.assertEqual([], dest.listall_references())
 
         dest_ref_name = "refs/merge/123"
         store.fetch_refs.apply_async(
@@ -549,11 +601,11 @@ class InitTestCase(TestCase):
                 [(orig_path, orig_commit_oid.hex, dest_path, dest_ref_name)],
             )
         )
-        celery_fixture.waitUntil(10, lambda: len(dest.references.objects) == 1)
+        celery_fixture.waitUntil(
+            10, lambda: len(dest.listall_references()) == 1
+        )
 
-        self.assertEqual(1, len(dest.references.objects))
-        copied_ref = dest.references.objects[0]
-        self.assertEqual(dest_ref_name, copied_ref.name)
+        self.assertEqual([dest_ref_name], dest.listall_references())
         self.assertEqual(
             orig.references[orig_ref_name].target,
             dest.references[dest_ref_name].target,
@@ -582,9 +634,7 @@ class InitTestCase(TestCase):
 
         celery_fixture.waitUntil(10, waitForNewCommit)
 
-        self.assertEqual(1, len(dest.references.objects))
-        copied_ref = dest.references.objects[0]
-        self.assertEqual(dest_ref_name, copied_ref.name)
+        self.assertEqual([dest_ref_name], dest.listall_references())
         self.assertEqual(
             orig.references[orig_ref_name].target,
             dest.references[dest_ref_name].target,
@@ -610,28 +660,31 @@ class InitTestCase(TestCase):
             ref=new_ref_name,
         )
 
-        before_refs_len = len(orig.references.objects)
+        before_refs_len = len(orig.listall_references())
         operations = [(orig_path, new_ref_name)]
         store.delete_refs.apply_async((operations,))
         celery_fixture.waitUntil(
-            10, lambda: len(orig.references.objects) < before_refs_len
+            10, lambda: len(orig.listall_references()) < before_refs_len
         )
 
-        self.assertEqual(before_refs_len - 1, len(orig.references.objects))
-        self.assertNotIn(
-            new_branch_name, [i.name for i in orig.references.objects]
-        )
+        refs = orig.listall_references()
+        self.assertEqual(before_refs_len - 1, len(refs))
+        self.assertNotIn(new_ref_name, refs)
 
     def hasZeroLooseObjects(self, path):
-        curdir = os.getcwd()
-        os.chdir(path)
-        objects = subprocess.check_output(["git", "count-objects"], text=True)
-        if int(objects[0 : (objects.find(" objects"))]) == 0:
-            os.chdir(curdir)
-            return True
-        else:
-            os.chdir(curdir)
-            return False
+        # Loose objects live in the two-hex-digit fan-out directories.
+        objects_path = os.path.join(path, "objects")
+        for dirname in os.listdir(objects_path):
+            if not store.object_dir_re.match(dirname):
+                continue
+            try:
+                if os.listdir(os.path.join(objects_path, dirname)):
+                    return False
+            except FileNotFoundError:
+                # git prune-packed removes emptied fan-out directories,
+                # possibly while we are polling.
+                pass
+        return True
 
     def test_repack(self):
         celery_fixture = CeleryWorkerFixture()
@@ -1,46 +1,98 @@
 # Copyright 2015 Canonical Ltd.  This software is licensed under the
 # GNU Affero General Public License version 3 (see the file LICENSE).
 
-import json
+import functools
 import os
 import re
+import stat
 
 import pyramid.httpexceptions as exc
 from cornice.resource import resource
 from cornice.validators import extract_cstruct
 from pygit2 import GitError
+from pyramid.interfaces import IRendererFactory
 from pyramid.response import Response
 
 from turnip.api import store
-from turnip.api.formatter import format_blob, format_commit
+from turnip.api.formatter import (
+    dumps_json,
+    format_blob,
+    format_commit,
+    iter_json,
+)
 from turnip.config import config
 
+# Splits "<commit>..<commit>" or "<commit>...<commit>", keeping the dots.
+diff_separator_re = re.compile(r"(\.{2,3})")
+
+
+@functools.lru_cache(maxsize=16)
+def _real_repo_store(repo_store):
+    """Return the resolved repo_store, with a trailing separator.
+
+    The repo store is fixed for the life of the process, so there is no
+    need to resolve it again on every request.
+    """
+    return os.path.join(os.path.realpath(repo_store), "")
+
 
 def is_valid_path(repo_store, repo_path):
     """Ensure path in within repo root and has not been subverted."""
-    return os.path.realpath(repo_path).startswith(os.path.realpath(repo_store))
+    # A direct child of the repo store that is not a symlink cannot
+    # escape it, so there is no need to resolve the whole path.
+    parent, name = os.path.split(repo_path)
+    if parent == os.path.normpath(repo_store) and name not in ("", ".", ".."):
+        try:
+            if not stat.S_ISLNK(os.lstat(repo_path).st_mode):
+                return True
+        except FileNotFoundError:
+            return True
+        except OSError:
+            # Leave unusual paths (too long, not a directory, etc.) to the
+            # full check below.
+            pass
+    return os.path.realpath(repo_path).startswith(_real_repo_store(repo_store))
+
+
+def json_stream_response(request, value):
+    """Return a response that streams value as JSON.
+
+    Objects that need adapting (such as bytes) are handled by the same
+    adapters as the API's JSON renderer.
+    """
+    renderer = request.registry.getUtility(IRendererFactory, "cornicejson")
+    default = renderer._make_default(request)
+    return Response(
+        app_iter=iter_json(value, default=default),
+        content_type="application/json",
+    )
 
 
 def validate_path(func):
     """Decorator validates repo path from request name and repo_store."""
 
+    @functools.wraps(func)
     def validate_path_decorator(self):
         name = self.request.matchdict["name"]
         if not name:
             self.request.errors.add("body", "name", "repo name is missing")
             return
-        repo_path = os.path.join(self.repo_store, name)
-        if not is_valid_path(self.repo_store, repo_path):
+        repo_store = self.repo_store
+        if not is_valid_path(repo_store, os.path.join(repo_store, name)):
             self.request.errors.add("body", "name", "invalid path.")
             raise exc.HTTPInternalServerError()
-        return func(self, self.repo_store, name)
+        return func(self, repo_store, name)
 
     return validate_path_decorator
 
 
 class BaseAPI:
-    def __init__(self):
-        self.repo_store = config.get("repo_store")
+    def __init__(self, request):
+        # Application settings take precedence over the environment.
+        settings = request.registry.settings
+        self.repo_store = settings.get("repo_store") or config.get(
+            "repo_store"
+        )
 
 
 @resource(collection_path="/repo", path="/repo/{name}")
@@ -48,7 +100,7 @@ class RepoAPI(BaseAPI):
     """Provides HTTP API for repository actions."""
 
     def __init__(self, request, context=None):
-        super().__init__()
+        super().__init__(request)
         self.request = request
 
     def collection_options(self):
@@ -145,7 +197,7 @@ class RepackAPI(BaseAPI):
     """Provides HTTP API for repository repacking."""
 
     def __init__(self, request, context=None):
-        super().__init__()
+        super().__init__(request)
         self.request = request
 
     @validate_path
@@ -166,7 +218,7 @@ class GarbageCollectAPI(BaseAPI):
     """Provides HTTP API for running gc for repository."""
 
     def __init__(self, request, context=None):
-        super().__init__()
+        super().__init__(request)
         self.request = request
 
     @validate_path
@@ -187,7 +239,7 @@ class RefCopyAPI(BaseAPI):
     """Provides HTTP API for git references copy operations."""
 
     def __init__(self, request, context=None):
-        super().__init__()
+        super().__init__(request)
         self.request = request
 
     def _validate_refs(self, repo_store, repo_name, refs_or_commits):
@@ -252,18 +304,19 @@ class RefAPI(BaseAPI):
     """Provides HTTP API for git references."""
 
     def __init__(self, request, context=None):
-        super().__init__()
+        super().__init__(request)
         self.request = request
 
     @validate_path
     def collection_get(self, repo_store, repo_name):
         exclude_prefixes = self.request.params.getall("exclude_prefix")
         try:
-            return store.get_refs(
+            refs = store.get_refs(
                 repo_store, repo_name, exclude_prefixes=exclude_prefixes
             )
         except (KeyError, GitError):
             return exc.HTTPNotFound()  # 404
+        return json_stream_response(self.request, refs)
 
     def _validate_refs_api_payload(self, refs_to_create):
         ref_set = set()
@@ -340,7 +393,7 @@ class RefAPI(BaseAPI):
             repo_store, repo_name, refs_to_create
         )
         resp = {"created": created, "errors": errors}
-        resp = json.dumps(resp).encode()
+        resp = dumps_json(resp)
 
         return (
             Response(resp, status=201, content_type="application/json")
@@ -385,13 +438,13 @@ class DiffAPI(BaseAPI):
     """
 
     def __init__(self, request, context=None):
-        super().__init__()
+        super().__init__(request)
         self.request = request
 
     @validate_path
     def get(self, repo_store, repo_name):
         """Returns diff of two commits."""
-        commits = re.split(r"(\.{2,3})", self.request.matchdict["commits"])
+        commits = diff_separator_re.split(self.request.matchdict["commits"])
         context_lines = int(self.request.params.get("context_lines", 3))
         if not len(commits) == 3:
             return exc.HTTPBadRequest()
@@ -423,7 +476,7 @@ class DiffMergeAPI(BaseAPI):
     """
 
     def __init__(self, request, context=None):
-        super().__init__()
+        super().__init__(request)
         self.request = request
 
     @validate_path
@@ -453,7 +506,7 @@ class CommitAPI(BaseAPI):
     """Provides HTTP API for git commits."""
 
     def __init__(self, request, context=None):
-        super().__init__()
+        super().__init__(request)
         self.request = request
 
     @validate_path
@@ -497,7 +550,7 @@ class LogAPI(BaseAPI):
     """Provides HTTP API for git logs."""
 
     def __init__(self, request, context=None):
-        super().__init__()
+        super().__init__(request)
         self.request = request
 
     @validate_path
@@ -511,7 +564,7 @@ class LogAPI(BaseAPI):
             log = store.get_log(repo_store, repo_name, sha1, limit, stop)
         except GitError:
             return exc.HTTPNotFound()
-        return log
+        return json_stream_response(self.request, log)
 
 
 @resource(path="/repo/{name}/detect-merges/{target}")
@@ -519,7 +572,7 @@ class DetectMergesAPI(BaseAPI):
     """Provides HTTP API for detecting merges."""
 
     def __init__(self, request, context=None):
-        super().__init__()
+        super().__init__(request)
         self.request = request
 
     @validate_path
@@ -551,7 +604,7 @@ class BlobAPI(BaseAPI):
     """Provides HTTP API for fetching blobs."""
 
     def __init__(self, request, context=None):
-        super().__init__()
+        super().__init__(request)
         self.request = request
 
     @validate_path
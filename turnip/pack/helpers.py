@@ -25,6 +25,9 @@ PKT_LEN_SIZE = 4
 PKT_PAYLOAD_MAX = 65520
 INCOMPLETE_PKT = object()
 
+# Prefer the libyaml-based loader where PyYAML was built with it.
+YAML_SAFE_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 
 def encode_packet(payload):
     if payload is None:
@@ -122,7 +125,7 @@ def ensure_config(repo_root):
     about concurrency.
     """
     with open("git.config.yaml") as config_file:
-        git_config_defaults = yaml.safe_load(config_file)
+        git_config_defaults = yaml.load(config_file, Loader=YAML_SAFE_LOADER)
     config = Repository(repo_root).config
     for key, val in git_config_defaults.items():
         config[key] = val